@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from typing import NamedTuple, AsyncIterable
+from typing import Callable, NamedTuple, AsyncIterable
 import asyncio
 
 
@@ -20,6 +24,80 @@ class NimSuggestCommands(str, Enum):
     project = "project"
 
 
+class _NimSuggestProtocol(asyncio.BufferedProtocol):
+    """Reads nimsuggest output into a reusable buffer and queues complete lines.
+
+    Reading is paused while more than `max_queued_lines` lines are waiting to be
+    consumed, so a large response can't outrun whoever is iterating over it.
+    """
+
+    def __init__(self, buffer_size: int = 65536, max_queued_lines: int = 64) -> None:
+        self._buffer = bytearray(buffer_size)
+        self._filled = 0
+        self._lines: asyncio.Queue[bytes | None] = asyncio.Queue()
+        self._max_queued_lines = max_queued_lines
+        self._paused = False
+        self._exc: Exception | None = None
+        self.closed = False
+        self.transport: asyncio.Transport | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._filled == len(self._buffer):
+            # A single line doesn't fit in the buffer, so make room for it
+            self._buffer.extend(bytes(len(self._buffer)))
+        return memoryview(self._buffer)[self._filled :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        buf = self._buffer
+        end = self._filled + nbytes
+        start = 0
+        while (newline := buf.find(b"\n", start, end)) != -1:
+            self._lines.put_nowait(bytes(buf[start:newline]))
+            start = newline + 1
+
+        # Move the incomplete trailing line to the start of the buffer
+        if start:
+            buf[: end - start] = buf[start:end]
+        self._filled = end - start
+
+        if not self._paused and self._lines.qsize() > self._max_queued_lines:
+            self._paused = True
+            self.transport.pause_reading()
+
+    def eof_received(self) -> None:
+        if self._filled:
+            self._lines.put_nowait(bytes(self._buffer[: self._filled]))
+            self._filled = 0
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.closed = True
+        self._exc = exc
+        self._lines.put_nowait(None)
+
+    async def readline(self) -> bytes | None:
+        """Get the next line without its newline, or None once the connection is closed."""
+        line = await self._lines.get()
+        if line is None:
+            if self._exc is not None:
+                raise self._exc
+        elif self._paused and self._lines.qsize() <= self._max_queued_lines // 2:
+            self._paused = False
+            self.transport.resume_reading()
+        return line
+
+
+def _format_command(
+    command_type: str, file: str | Path, line: int | None, col: int | None
+) -> bytes:
+    if isinstance(command_type, NimSuggestCommands):
+        command_type = command_type.value
+    location = f"{file}:{line}:{col}" if line and col else file
+    return f"{command_type} {location}\n".encode()
+
+
 async def query_nimsuggest(
     command_type: str,
     file: str | Path,
@@ -27,20 +105,237 @@ async def query_nimsuggest(
     col: int | None = None,
     host: str = "localhost",
     port: int = 6000,
-) -> AsyncIterable[str]:
-    reader, writer = await asyncio.open_connection(host, port)
+) -> AsyncIterable[bytes]:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(_NimSuggestProtocol, host, port)
+
+    try:
+        transport.write(_format_command(command_type, file, line, col))
+        while (raw := await protocol.readline()) is not None:
+            if raw.endswith(b"\r"):
+                raw = raw[:-1]
+            if not raw:
+                continue
+            yield raw
+    finally:
+        transport.close()
+
+
+class NimSuggestPool:
+    """Sends nimsuggest queries over a shared connection instead of opening one per query.
+
+    Requests are serialized under a lock, and a response ends at the blank line
+    nimsuggest sends after it. If the server closes the connection instead, a
+    new one is opened for the next request.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6000) -> None:
+        self.host = host
+        self.port = port
+        self._conn: tuple[asyncio.Transport, _NimSuggestProtocol] | None = None
+        self._lock = asyncio.Lock()
+        self._exit_stack = AsyncExitStack()
+
+    async def _connect(self) -> tuple[asyncio.Transport, _NimSuggestProtocol]:
+        if self._conn is None or self._conn[1].closed:
+            # Unwinding the stack closes the previous, stale transport if there is one
+            await self._exit_stack.aclose()
+            loop = asyncio.get_running_loop()
+            transport, protocol = await loop.create_connection(
+                _NimSuggestProtocol, self.host, self.port
+            )
+            self._exit_stack.callback(transport.close)
+            self._conn = transport, protocol
+        return self._conn
+
+    async def request(
+        self,
+        command_type: str,
+        file: str | Path,
+        line: int | None = None,
+        col: int | None = None,
+    ) -> AsyncIterable[bytes]:
+        """Send a command and yield the non-blank lines of its response."""
+        command = _format_command(command_type, file, line, col)
+        async with self._lock:
+            # The server may have closed a connection kept from an earlier request
+            # without us having noticed yet. If it turns out to be dead before any
+            # response arrives, the command is sent again on a new connection.
+            reused = self._conn is not None and not self._conn[1].closed
+            while True:
+                transport, protocol = await self._connect()
+                transport.write(command)
+
+                received = False
+                complete = False
+                try:
+                    while True:
+                        try:
+                            raw = await protocol.readline()
+                        except ConnectionError:
+                            if received or not reused:
+                                raise
+                            raw = None
+                        if raw is None:
+                            complete = True
+                            self._conn = None
+                            break
+                        if raw.endswith(b"\r"):
+                            raw = raw[:-1]
+                        if not raw:
+                            complete = True
+                            break
+                        received = True
+                        yield raw
+                finally:
+                    if not complete:
+                        # The rest of the response is still in flight, so the
+                        # connection can't be reused for the next request
+                        self._conn = None
+                        await self._exit_stack.aclose()
+
+                if received or not reused or self._conn is not None:
+                    return
+                reused = False
+
+    async def request_all(
+        self,
+        command_type: str,
+        file: str | Path,
+        line: int | None = None,
+        col: int | None = None,
+    ) -> list[bytes]:
+        """Send a command and return all the non-blank lines of its response at once."""
+        return [raw async for raw in self.request(command_type, file, line, col)]
+
+    async def close(self) -> None:
+        self._conn = None
+        await self._exit_stack.aclose()
 
-    location = f"{file}:{line}:{col}" if line and col else file
-    command = f"{command_type} {location}\n"
-    writer.write(command.encode())
-    await writer.drain()
 
-    async for line in reader:
-        decoded = line.decode().strip()
-        if not decoded:
-            continue
-        yield decoded
-    writer.close()
+_pools: dict[asyncio.AbstractEventLoop, dict[tuple[str, int], NimSuggestPool]] = {}
+
+
+def get_pool(host: str = "localhost", port: int = 6000) -> NimSuggestPool:
+    """Get the shared NimSuggestPool for the given server on the running event loop.
+
+    Pools are kept per loop, as their connection and lock can only be used from
+    the loop that created them.
+    """
+    loop = asyncio.get_running_loop()
+    loop_pools = _pools.get(loop)
+    if loop_pools is None:
+        # Forget the pools of loops that have since been closed
+        for closed_loop in [other for other in _pools if other.is_closed()]:
+            del _pools[closed_loop]
+        loop_pools = _pools[loop] = {}
+
+    pool = loop_pools.get((host, port))
+    if pool is None:
+        pool = loop_pools[host, port] = NimSuggestPool(host, port)
+    return pool
+
+
+async def close_pools() -> None:
+    """Close the connections of all the pools on the running event loop."""
+    for pool in _pools.pop(asyncio.get_running_loop(), {}).values():
+        await pool.close()
+
+
+_INT_FIELDS = frozenset({"line", "column", "score"})
+_PATH_FIELDS = frozenset({"file"})
+
+
+@lru_cache(maxsize=4096)
+def _intern_path(path: str) -> Path:
+    """Get a shared Path for `path`, as the same file is repeated across most output lines."""
+    return Path(path)
+
+
+def _make_parser(
+    cls: type[NamedTuple],
+    int_fields: frozenset[str] = _INT_FIELDS,
+    path_fields: frozenset[str] = _PATH_FIELDS,
+) -> Callable[[bytes | str], NamedTuple]:
+    """Generate a `from_line` parser specialized to the fields of `cls`.
+
+    The generated function unpacks the split line straight into one local per
+    field and converts each in a single expression, with no loops or lookups
+    by field name. The split is bounded to the number of fields, so a tab in
+    the last field ends up in its value. E.g. for a 3 field tuple with an int
+    in the middle:
+
+        def from_line(output):
+            if output.__class__ is bytes:
+                output = output.decode()
+            f0, f1, f2 = output.split('\\t', 2)
+            return _tuple_new(cls, (f0, int(f1), f2))
+    """
+    targets = []
+    values = []
+    for i, name in enumerate(cls._fields):
+        targets.append(f"f{i}")
+        if name in int_fields:
+            values.append(f"int(f{i})")
+        elif name in path_fields:
+            values.append(f"_intern_path(f{i})")
+        else:
+            values.append(f"f{i}")
+
+    source = (
+        "def from_line(output):\n"
+        "    if output.__class__ is bytes:\n"
+        "        output = output.decode()\n"
+        f"    {', '.join(targets)} = output.split('\\t', {len(targets) - 1})\n"
+        f"    return _tuple_new(cls, ({', '.join(values)},))\n"
+    )
+    namespace = {"cls": cls, "_intern_path": _intern_path, "_tuple_new": tuple.__new__}
+    exec(compile(source, f"<{cls.__name__}.from_line>", "exec"), namespace)
+
+    from_line = namespace["from_line"]
+    from_line.__doc__ = f"Parse a nimsuggest output string into a {cls.__name__}."
+    return from_line
+
+
+async def _query(
+    cls: type[NamedTuple],
+    file: str | Path,
+    line: int | None = None,
+    col: int | None = None,
+    host: str = "localhost",
+    port: int = 6000,
+) -> AsyncIterable[NamedTuple]:
+    """Run the nimsuggest command for `cls` and parse each line of its output."""
+    from_line = cls.from_line
+    async for output in get_pool(host, port).request(cls._command, file, line, col):
+        yield from_line(output)
+
+
+async def _query_all(
+    cls: type[NamedTuple],
+    file: str | Path,
+    line: int | None = None,
+    col: int | None = None,
+    host: str = "localhost",
+    port: int = 6000,
+) -> list[NamedTuple]:
+    """Run the nimsuggest command for `cls` and parse its whole output in one pass.
+
+    Unlike `_query`, this waits for the full response and then parses all of its
+    lines with `map`, instead of resuming an async generator for every line.
+    """
+    lines = await get_pool(host, port).request_all(cls._command, file, line, col)
+    return list(map(cls.from_line, lines))
+
+
+def _specialize(cls: type[NamedTuple], command: NimSuggestCommands) -> None:
+    """Attach the command, generated `from_line` and, unless overridden, `query` to `cls`."""
+    # The value is stored, as formatting a str-mixin enum member gives its qualified name
+    cls._command = command.value
+    cls.from_line = staticmethod(_make_parser(cls))
+    cls.query_all = classmethod(_query_all)
+    if "query" not in vars(cls):
+        cls.query = classmethod(_query)
 
 
 class NimSuggestionOutput(NamedTuple):
@@ -84,37 +379,122 @@ class NimSuggestionOutput(NamedTuple):
         col: int | None = None,
         host: str = "localhost",
         port: int = 6000,
+        prefix: str | None = None,
     ) -> AsyncIterable[NimSuggestionOutput]:
-        async for line in query_nimsuggest("sug", file, line, col, host, port):
-            yield cls.from_line(line)
+        """Query nimsuggest for suggestions at the given location.
+
+        If `prefix` (the part of the identifier typed before the cursor) is given,
+        the results are kept in `suggestion_cache`, and a later query for the same
+        identifier with more characters typed is answered from it without asking
+        nimsuggest again.
+        """
+        cacheable = prefix is not None and line is not None and col is not None
+        if cacheable:
+            cached = suggestion_cache.lookup(file, line, col, prefix)
+            if cached is not None:
+                for suggestion in cached:
+                    yield suggestion
+                return
+
+        suggestions = []
+        async for suggestion in _query(cls, file, line, col, host, port):
+            suggestions.append(suggestion)
+            yield suggestion
+
+        if cacheable:
+            suggestion_cache.insert(file, line, col, prefix, suggestions)
+
+
+class _CachedSuggestions(NamedTuple):
+    col: int
+    prefix: str
+    identifiers: list[str]
+    suggestions: list[tuple[int, NimSuggestionOutput]]
+
+
+def _normalize_identifier(name: str) -> str:
+    # Nim compares identifiers ignoring underscores and the case of all but the
+    # first character, e.g. `to_seq` and `toSeq` are the same identifier
+    return name[:1] + name[1:].replace("_", "").lower()
+
+
+def _identifier(suggestion: NimSuggestionOutput) -> str:
+    # `symbol` holds the signature for routines, so the name comes from the last
+    # part of the qualified name instead, e.g. `system.csize` -> `csize`
+    return _normalize_identifier(suggestion.module.rpartition(".")[2])
+
+
+class SuggestionCache:
+    """An LRU cache of `sug` results, keyed by file and line.
+
+    Each entry remembers the column and identifier prefix it was queried with.
+    A lookup on the same line hits if the user has since typed up to
+    `max_scan_back` more characters of the same identifier, i.e. the new prefix
+    extends the cached one and the column moved forward by the same amount. The
+    cached suggestions are kept sorted by identifier, so the ones matching the new
+    prefix are found by bisection and returned in nimsuggest's original order.
+
+    Identifiers and prefixes are compared the way Nim compares identifiers, but
+    a hit only returns the suggestions that start with the new prefix. nimsuggest
+    itself also matches substrings and abbreviations, so a hit can be narrower
+    than a live query at the same spot, e.g. `toSeq` for `seq`.
+    """
 
-    @classmethod
-    def from_line(cls, output: str) -> NimSuggestionOutput:
-        """Parse a nimsuggest output string into a NimSuggestionOutput."""
-        (
-            suggestion_type,
-            suggestion_node_type,
-            module,
-            symbol,
-            file,
-            line,
-            column,
-            documentation,
-            score,
-            parent,
-        ) = output.split("\t")
-        return cls(
-            suggestion_type=suggestion_type,
-            suggestion_node_type=suggestion_node_type,
-            module=module,
-            symbol=symbol,
-            file=Path(file),
-            line=int(line),
-            column=int(column),
-            documentation=documentation,
-            score=int(score),
-            parent=parent,
+    def __init__(self, maxsize: int = 128, max_scan_back: int = 10) -> None:
+        self.maxsize = maxsize
+        self.max_scan_back = max_scan_back
+        self._entries: OrderedDict[tuple[str, int], _CachedSuggestions] = OrderedDict()
+
+    def lookup(
+        self, file: str | Path, line: int, col: int, prefix: str
+    ) -> list[NimSuggestionOutput] | None:
+        """Get the cached suggestions matching `prefix`, or None on a miss."""
+        key = (str(file), line)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        typed = len(prefix) - len(entry.prefix)
+        if not (
+            0 <= typed <= self.max_scan_back
+            and col - entry.col == typed
+            and prefix.startswith(entry.prefix)
+        ):
+            return None
+        self._entries.move_to_end(key)
+
+        normalized = _normalize_identifier(prefix)
+        start = bisect_left(entry.identifiers, normalized)
+        matches = []
+        for identifier, suggestion in zip(entry.identifiers[start:], entry.suggestions[start:]):
+            if not identifier.startswith(normalized):
+                break
+            matches.append(suggestion)
+        return [suggestion for _, suggestion in sorted(matches)]
+
+    def insert(
+        self,
+        file: str | Path,
+        line: int,
+        col: int,
+        prefix: str,
+        suggestions: list[NimSuggestionOutput],
+    ) -> None:
+        """Store the suggestions nimsuggest returned for the given location."""
+        by_identifier = sorted(enumerate(suggestions), key=lambda item: _identifier(item[1]))
+        key = (str(file), line)
+        self._entries[key] = _CachedSuggestions(
+            col=col,
+            prefix=prefix,
+            identifiers=[_identifier(suggestion) for _, suggestion in by_identifier],
+            suggestions=by_identifier,
         )
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+suggestion_cache = SuggestionCache()
 
 
 class NimDefinitionOutput(NamedTuple):
@@ -143,44 +523,6 @@ class NimDefinitionOutput(NamedTuple):
     documentation: str
     score: int
 
-    @classmethod
-    async def query(
-        cls,
-        file: str | Path,
-        line: int | None = None,
-        col: int | None = None,
-        host: str = "localhost",
-        port: int = 6000,
-    ) -> AsyncIterable[NimDefinitionOutput]:
-        async for line in query_nimsuggest("def", file, line, col, host, port):
-            yield cls.from_line(line)
-
-    @classmethod
-    def from_line(cls, output: str) -> NimDefinitionOutput:
-        """Parse a nimsuggest output string into a NimSuggestionOutput."""
-        (
-            suggestion_type,
-            suggestion_node_type,
-            module,
-            symbol,
-            file,
-            line,
-            column,
-            documentation,
-            score,
-        ) = output.split("\t")
-        return cls(
-            suggestion_type=suggestion_type,
-            suggestion_node_type=suggestion_node_type,
-            module=module,
-            symbol=symbol,
-            file=Path(file),
-            line=int(line),
-            column=int(column),
-            documentation=documentation,
-            score=int(score),
-        )
-
 
 class NimUseOutput(NamedTuple):
     """A nimsuggest use output.
@@ -208,44 +550,6 @@ class NimUseOutput(NamedTuple):
     documentation: str
     score: int
 
-    @classmethod
-    async def query(
-        cls,
-        file: str | Path,
-        line: int | None = None,
-        col: int | None = None,
-        host: str = "localhost",
-        port: int = 6000,
-    ) -> AsyncIterable[NimDefinitionOutput]:
-        async for line in query_nimsuggest("use", file, line, col, host, port):
-            yield cls.from_line(line)
-
-    @classmethod
-    def from_line(cls, output: str) -> NimUseOutput:
-        """Parse a nimsuggest output string into a NimSuggestionOutput."""
-        (
-            suggestion_type,
-            suggestion_node_type,
-            module,
-            symbol,
-            file,
-            line,
-            column,
-            documentation,
-            score,
-        ) = output.split("\t")
-        return cls(
-            suggestion_type=suggestion_type,
-            suggestion_node_type=suggestion_node_type,
-            module=module,
-            symbol=symbol,
-            file=Path(file),
-            line=int(line),
-            column=int(column),
-            documentation=documentation,
-            score=int(score),
-        )
-
 
 class NimCheckOutput(NamedTuple):
     """A nimsuggest definition output.
@@ -282,34 +586,15 @@ class NimCheckOutput(NamedTuple):
         host: str = "localhost",
         port: int = 6000,
     ) -> AsyncIterable[NimCheckOutput]:
-        async for line in query_nimsuggest("chk", file, line, col, host, port):
-            yield cls.from_line(line)
+        """Check a file, parsing the whole `chk` dump at once with `query_all`."""
+        for check in await cls.query_all(file, line, col, host, port):
+            yield check
 
-    @classmethod
-    def from_line(cls, output: str) -> NimCheckOutput:
-        """Parse a nimsuggest output string into a NimSuggestionOutput."""
-        (
-            suggestion_type,
-            suggestion_node_type,
-            module,
-            symbol,
-            file,
-            line,
-            column,
-            documentation,
-            score,
-        ) = output.split("\t")
-        return cls(
-            suggestion_type=suggestion_type,
-            suggestion_node_type=suggestion_node_type,
-            module=module,
-            symbol=symbol,
-            file=Path(file),
-            line=int(line),
-            column=int(column),
-            documentation=documentation,
-            score=int(score),
-        )
+
+_specialize(NimSuggestionOutput, NimSuggestCommands.sug)
+_specialize(NimDefinitionOutput, NimSuggestCommands.def_)
+_specialize(NimUseOutput, NimSuggestCommands.use)
+_specialize(NimCheckOutput, NimSuggestCommands.chk)
 
 
 def get_event_loop() -> asyncio.AbstractEventLoop:
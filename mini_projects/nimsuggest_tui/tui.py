@@ -1,5 +1,7 @@
 import asyncio
+import os
 from pathlib import Path
+from typing import Iterator
 import argparse
 
 from rich.panel import Panel
@@ -9,7 +11,7 @@ from textual.binding import Binding
 from textual.containers import Grid
 from textual.widgets import Header, Placeholder, Footer
 
-from mini_projects.nimsuggest_tui.nimsuggest_tui import NimSuggest, NimSuggestCommands
+from mini_projects.nimsuggest_tui.nimsuggest_tui import NimSuggestionOutput, close_pools
 
 
 class Logger:
@@ -17,18 +19,48 @@ class Logger:
         textual_log(Panel(*args, **kwargs, style="on red"))
 
     def __getattr__(self, name: str) -> object:
+        # Only reached when `name` isn't set on the instance yet, so each wrapper
+        # is built once and later calls find it as a plain attribute
         attr = getattr(textual_log, name)
         if callable(attr):
 
             def wrapper(*args: object, **kwargs: object) -> None:
                 attr(Panel(*args, **kwargs, style="on red"))
 
+            setattr(self, name, wrapper)
             return wrapper
 
 
 log = Logger()
 
 
+NIM_SOURCE_SUFFIXES = (".nim",)
+
+
+def _iter_nim_files(root: Path, suffixes: tuple[str, ...] = NIM_SOURCE_SUFFIXES) -> Iterator[Path]:
+    """Recursively yield the files under `root` ending in one of `suffixes`.
+
+    This walks the tree with `os.scandir`, so entry types come from the cached
+    `DirEntry` data rather than a `stat` per path, and only the matches are
+    turned into `Path` objects. Names are matched with a single `str.endswith`
+    call on the suffix tuple instead of a glob pattern. Like `Path.rglob`,
+    symlinked directories aren't followed, and directories that are unreadable,
+    missing or not directories at all are skipped.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(suffixes) and entry.is_file():
+                    yield Path(entry.path)
+
+
 class MyApp(App):
     BINDINGS = (Binding("q", "quit", "Quit"),)
 
@@ -43,18 +75,47 @@ class MyApp(App):
         args = parser.parse_args()
 
         self.project_file = args.project_file or Path("mini_projects.nimble")
-        self.project_nim_files = self.project_file.parent.rglob("**/*.nim")
+        self.project_nim_files = list(_iter_nim_files(self.project_file.parent))
 
         self.log.info(f"Project file: {self.project_file}")
         self.log.info(f"Project files: {self.project_nim_files}")
 
-        self._nimsuggest = NimSuggest(self.project_file)
+    async def _provide_suggestions(self, concurrency: int = 4) -> None:
+        """Ask nimsuggest about every project file, keeping several requests in flight.
+
+        The files go through a bounded queue to `concurrency` consumers, so the
+        producer can't run far ahead of them. The consumers share the pool from
+        `get_pool`, which sends one request at a time under its lock, so requests
+        don't overlap on the connection; the next one is just queued as soon as
+        the previous response ends.
+        """
+        files: asyncio.Queue[Path | None] = asyncio.Queue(maxsize=32)
 
-    async def _provide_suggestions(self):
-        async with self._nimsuggest:
+        async def produce() -> None:
             for file in self.project_nim_files:
+                await files.put(file)
+            for _ in range(concurrency):
+                await files.put(None)
+
+        async def consume() -> None:
+            while (file := await files.get()) is not None:
                 self.log.info(f"Providing suggestions for {file}")
-                await self._nimsuggest.send(NimSuggestCommands.sug, file, 1, 0)
+                suggestions = [s async for s in NimSuggestionOutput.query(file, 1, 0)]
+                self.log.info(f"Got {len(suggestions)} suggestions for {file}")
+
+        tasks = [
+            asyncio.create_task(produce()),
+            *(asyncio.create_task(consume()) for _ in range(concurrency)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def on_unmount(self) -> None:
+        await close_pools()
 
     async def on_click(self, event: events.Click) -> None:
         log.error(f"Mickey move: {event}")
@@ -3,14 +3,20 @@ from __future__ import annotations
 import asyncio
 import json
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
 from typing import TypeAlias, Union
 
 import httpx
 from loguru import logger
 
-client = httpx.AsyncClient()
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 BASE_URL = "https://raw.githubusercontent.com/"
+ETAGS_PATH = Path(__file__).parent / "node_json" / "etags.json"
 
 NodeTypesDict: TypeAlias = dict[str, Union[str, bool, "NodeTypesDict"]]
 
@@ -56,7 +62,18 @@ class Language(str, Enum):
 
     @property
     def node_types_dict(self) -> list[NodeTypesDict]:
-        return json.loads(self.node_types_json_path.read_text())
+        path = self.node_types_json_path
+        return _load_node_types(path, path.stat().st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _load_node_types(path: Path, mtime_ns: int) -> list[NodeTypesDict]:
+    """Parse a node-types.json file, cached by path and modification time.
+
+    The mtime is part of the key so that files rewritten by
+    `update_node_json_files` are parsed again.
+    """
+    return _json_loads(path.read_bytes())
 
 
 LANGUAGE_ROUTES = {
@@ -95,23 +112,69 @@ LANGUAGE_ROUTES = {
 # reason (likely because e.g. Haskell is enormous)
 
 
-async def _update_node_json_file(language: Language, client: httpx.AsyncClient) -> None:
-    """Get language from tree-sitter."""
+async def _update_node_json_file(
+    language: Language, client: httpx.AsyncClient, etags: dict[str, str]
+) -> None:
+    """Get language from tree-sitter.
+
+    The request is conditional on the ETag of the last download, so files that
+    didn't change upstream get an empty 304 response instead of a full body.
+    """
     logger.info(f"Getting {language} node-types.json")
     url = BASE_URL + LANGUAGE_ROUTES[language]
-    response = await client.get(url, follow_redirects=True)
-    response.raise_for_status()
-    response = await response.aread()
-    logger.info(f"Got {language} node-types.json - {len(response)} bytes")
-    language.node_types_json_path.write_bytes(response)
+    headers = {}
+    if language.value in etags and language.node_types_json_path.exists():
+        headers["If-None-Match"] = etags[language.value]
+
+    path = language.node_types_json_path
+    partial_path = path.with_name(f"{path.name}.part")
+    async with client.stream("GET", url, headers=headers, follow_redirects=True) as response:
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            logger.info(f"node_types_{language}.json is up to date")
+            return
+        response.raise_for_status()
+
+        # Write the body in chunks as it arrives rather than holding all of it
+        # in memory, and only replace the old file once the download is complete
+        try:
+            with partial_path.open("wb") as f:
+                async for chunk in response.aiter_bytes(65536):
+                    f.write(chunk)
+            logger.info(f"Got {language} node-types.json - {partial_path.stat().st_size} bytes")
+            partial_path.replace(path)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        if etag := response.headers.get("ETag"):
+            etags[language.value] = etag
     logger.info(f"Updated node_types_{language}.json")
 
 
 async def update_node_json_files() -> None:
-    """Update node.json files for all languages in tree-sitter."""
+    """Update node.json files for all languages in tree-sitter.
+
+    All files are fetched concurrently as streams of a single HTTP/2 connection.
+    """
     logger.info("Updating node_types json files")
-    tasks = [_update_node_json_file(language, client) for language in LANGUAGE_ROUTES]
-    await asyncio.gather(*tasks)
+    try:
+        etags = json.loads(ETAGS_PATH.read_text())
+    except FileNotFoundError:
+        etags = {}
+
+    client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+        timeout=httpx.Timeout(30.0),
+    )
+    try:
+        async with client:
+            tasks = [
+                _update_node_json_file(language, client, etags) for language in LANGUAGE_ROUTES
+            ]
+            await asyncio.gather(*tasks)
+    finally:
+        ETAGS_PATH.write_text(json.dumps(etags, indent=4, sort_keys=True))
     logger.success("Updated node_types json files!")
 
 
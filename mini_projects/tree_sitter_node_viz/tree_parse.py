@@ -1,14 +1,51 @@
 from __future__ import annotations
 
+import hashlib
+import os
+import pickle
+import tempfile
 from dataclasses import field, dataclass
+from pathlib import Path
 
+from loguru import logger
 from rich.console import Console
+from rich.text import Text
 from rich.tree import Tree
 
 from mini_projects.tree_sitter_node_viz.base import Language, NodeTypesDict
 
 
-@dataclass
+_MULTIPLE = "[bold orange1]*[/]"
+_OPTIONAL = "[bold orange1]?[/]"
+_NAMED_TRUE = "(named: [green]True[/])"
+_NAMED_FALSE = "(named: [red]False[/])"
+
+# The labels shared by every type's tree are parsed from markup once, here. Rich
+# and Textual copy a Text label when rendering it, so one instance can be used in
+# any number of trees.
+NAMED_LABELS = {
+    True: Text.from_markup("[bold green]named[/]: [green]True[/]"),
+    False: Text.from_markup("[bold green]named[/]: [red]False[/]"),
+}
+FIELDS_LABEL = Text.from_markup("[bold green]fields[/]:")
+# Keyed by the `multiple` and `required` flags of the children
+CHILDREN_LABELS = {
+    (multiple, required): Text.from_markup(
+        "".join(
+            (
+                _MULTIPLE if multiple else "",
+                "[bold green]children[/]",
+                "" if required else _OPTIONAL,
+                ":",
+            )
+        )
+    )
+    for multiple in (True, False)
+    for required in (True, False)
+}
+
+
+@dataclass(slots=True)
 class TreeSitterType:
 
     name: str
@@ -16,32 +53,79 @@ class TreeSitterType:
     fields: dict[str, TreeSitterField] = field(default_factory=dict)
     children: TreeSitterField | None = None
 
+    # Memoized markup, as cached_property can't be used with slots
+    _rich_fields: tuple[tuple[str, str], ...] | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _rich_children: tuple[tuple[str, str], ...] | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
     def __str__(self):
         return f"TreeSitterType({self.name})"
 
     def __rich__(self):
         return f"TreeSitterType([bold yellow]{self.name}[/])"
 
-    def rich_fields(self) -> dict[str, str]:
-        d = {}
-        for field_name, field_data in self.fields.items():
-            multiple_indicator = "[bold orange1]*[/]" if field_data.multiple else ""
-            optional_indicator = "[bold orange1]?[/]" if not field_data.required else ""
-            d[field_name] = f"{multiple_indicator}[bold blue]{field_name}[/]{optional_indicator}"
-        return d
-
-    def rich_children(self) -> dict[str, str]:
-        d = {}
-        if self.children:
-            for child_type in self.children.types:
-                named_indicator = "[green]True[/]" if child_type.named else "[red]False[/]"
-                named_indicator = f"(named: {named_indicator})"
-
-                d[child_type.name] = f"[bold blue]{child_type.name}[/] {named_indicator}"
-        return d
+    @property
+    def label(self) -> Text:
+        return Text(self.name, style="bold blue")
+
+    @property
+    def named_label(self) -> Text:
+        return NAMED_LABELS[self.named]
+
+    @property
+    def children_label(self) -> Text | None:
+        """The label of the children subtree, with the `*` and `?` indicators."""
+        if self.children is None:
+            return None
+        return CHILDREN_LABELS[self.children.multiple, self.children.required]
+
+    @property
+    def rich_fields(self) -> tuple[tuple[str, str], ...]:
+        """The `(name, markup)` pairs of the fields, in the order of `fields`."""
+        if self._rich_fields is None:
+            self._rich_fields = tuple(
+                (
+                    field_name,
+                    "".join(
+                        (
+                            _MULTIPLE if field_data.multiple else "",
+                            "[bold blue]",
+                            field_name,
+                            "[/]",
+                            "" if field_data.required else _OPTIONAL,
+                        )
+                    ),
+                )
+                for field_name, field_data in self.fields.items()
+            )
+        return self._rich_fields
+
+    @property
+    def rich_children(self) -> tuple[tuple[str, str], ...]:
+        """The `(name, markup)` pairs of the children types, in the order of `children.types`."""
+        if self._rich_children is None:
+            children_types = self.children.types if self.children else ()
+            self._rich_children = tuple(
+                (
+                    child_type.name,
+                    "".join(
+                        (
+                            "[bold blue]",
+                            child_type.name,
+                            "[/] ",
+                            _NAMED_TRUE if child_type.named else _NAMED_FALSE,
+                        )
+                    ),
+                )
+                for child_type in children_types
+            )
+        return self._rich_children
 
 
-@dataclass
+@dataclass(slots=True)
 class TreeSitterField:
 
     multiple: bool
@@ -58,50 +142,94 @@ def create_types_and_fields(data: list[NodeTypesDict]):
         type_data["type"]: TreeSitterType(name=type_data["type"], named=type_data["named"])
         for type_data in data
     }
+    get_type = types.get
 
     for type_data in data:
         fields = type_data.get("fields")
         children = type_data.get("children")
+        if not fields and not children:
+            continue
+        type_ = types[type_data["type"]]
 
         if fields:
-
+            type_fields = type_.fields
             for field_name, field_data in fields.items():
-                field_ = TreeSitterField(
+                type_fields[field_name] = TreeSitterField(
                     multiple=field_data["multiple"],
                     required=field_data["required"],
-                    types=[types[t["type"]] for t in field_data["types"] if t["type"] in types],
+                    types=[
+                        t for td in field_data["types"] if (t := get_type(td["type"])) is not None
+                    ],
                 )
-                types[type_data["type"]].fields[field_name] = field_
 
         if children:
-            types[type_data["type"]].children = TreeSitterField(
+            type_.children = TreeSitterField(
                 multiple=children["multiple"],
                 required=children["required"],
-                types=[types[t["type"]] for t in children["types"]],
+                types=[t for td in children["types"] if (t := get_type(td["type"])) is not None],
             )
 
     return types
 
 
+# Bump whenever the pickled layout of TreeSitterType or TreeSitterField changes
+CACHE_VERSION = 3
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "tree_viz"
+
+
+def load_types_cached(lang: Language) -> dict[str, TreeSitterType]:
+    """Get the types for `lang`, going through a pickle cache in `CACHE_DIR`.
+
+    Entries are keyed by a hash of `CACHE_VERSION` and the node-types JSON, so
+    updating the JSON file makes a new entry rather than reusing a stale one.
+    """
+    content = lang.node_types_json_path.read_bytes()
+    digest = hashlib.sha256(f"{CACHE_VERSION}:".encode() + content).hexdigest()
+    cache = CACHE_DIR / digest[:2] / f"{digest[2:]}.pickle"
+    try:
+        return pickle.loads(cache.read_bytes())
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable cache entry {cache}: {e}")
+
+    types = create_types_and_fields(lang.node_types_dict)
+
+    data = pickle.dumps(types, protocol=5)
+
+    # Written to a temporary file first so a concurrent reader never sees a partial entry,
+    # which is removed again if anything goes wrong before it's moved into place
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError as e:
+        # Unlike the temp directory, the user's cache directory may not be writable
+        logger.warning(f"Not caching types for {lang}: {e}")
+    return types
+
+
 def nodes_rich_tree(node: TreeSitterType) -> Tree:
     """Print a tree of the nodes in a rich format."""
-    tree = Tree(f"[bold blue]{node.name}[/]")
-    color_named = "green" if node.named else "red"
-    tree.add(f"[bold green]named[/]: [{color_named}]{node.named}[/]")
+    tree = Tree(node.label)
+    tree.add(node.named_label)
 
     if node.fields:
-        fields_tree = tree.add(f"[bold green]fields[/]:")
-        for field_name, field_data in node.rich_fields().items():
+        fields_tree = tree.add(FIELDS_LABEL)
+        for field_name, field_data in node.rich_fields:
             fields_tree.add(f"[bold yellow]{field_name}[/]: {field_data}")
 
     if node.children:
+        children_tree = tree.add(node.children_label)
 
-        multiple_indicator = "[bold orange1]*[/]" if node.children.multiple else ""
-        optional_indicator = "[bold orange1]?[/]" if not node.children.required else ""
-        children_label = f"{multiple_indicator}[bold green]children[/]{optional_indicator}:"
-        children_tree = tree.add(children_label)
-
-        for child_name, child_data in node.rich_children().items():
+        for child_name, child_data in node.rich_children:
 
             children_tree.add(f"[bold yellow]{child_name}[/]: {child_data}")
 
@@ -109,7 +237,7 @@ def nodes_rich_tree(node: TreeSitterType) -> Tree:
 
 
 def main():
-    ts = create_types_and_fields(Language.python.node_types_dict)
+    ts = load_types_cached(Language.python)
 
     root = Tree("[bold]TreeSitter Nodes[/]")
     for type_ in ts.values():
@@ -1,5 +1,7 @@
 import asyncio
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 
 from asynkets import Switch
 from rich.text import Text
@@ -25,9 +27,11 @@ from textual.widgets import (
 
 from mini_projects.tree_sitter_node_viz.base import Language
 from mini_projects.tree_sitter_node_viz.tree_parse import (
+    FIELDS_LABEL,
     TreeSitterType,
     TreeSitterField,
     create_types_and_fields,
+    load_types_cached,
 )
 
 DEFAULT_COLORS = {
@@ -43,6 +47,40 @@ DEFAULT_COLORS = {
 }
 
 
+# Like the labels in tree_parse, these are built as Text up front, as a markup
+# string would be parsed again for every node added
+MULTIPLE_PREFIX = Text.from_markup("[bold green]multiple[/]: ")
+REQUIRED_PREFIX = Text.from_markup("[bold green]required[/]: ")
+TYPES_LABEL = Text.from_markup("[bold green]types[/]")
+
+
+def _prefixed(prefix: Text, value: object) -> Text:
+    label = prefix.copy()
+    label.append(str(value))
+    return label
+
+
+@contextmanager
+def batch_tree_updates(tree: Tree) -> Iterator[None]:
+    """Invalidate `tree` once when the block exits, rather than on every node change.
+
+    Textual's Tree has no batching API of its own and re-lays itself out on each node
+    added, expanded or collapsed, so its invalidation is a no-op inside the block.
+    """
+    if "_invalidate" in vars(tree):
+        # Already batching
+        yield
+        return
+
+    invalidate = tree._invalidate
+    tree._invalidate = lambda: None
+    try:
+        yield
+    finally:
+        del tree._invalidate
+        invalidate()
+
+
 def add_tree_node(
     tree_node: TreeNode[TreeSitterType | TreeSitterField],
     node: TreeSitterType,
@@ -51,41 +89,28 @@ def add_tree_node(
 ) -> TreeNode:
 
     tree = tree_node.add(
-        f"[bold blue]{node.name}[/]",
+        node.label,
         node,
         expand=expand,
         allow_expand=allow_expand,
     )
-    color_named = "green" if node.named else "red"
-    tree.add_leaf(f"[bold green]named[/]: [{color_named}]{node.named}[/]", node)
+    tree.add_leaf(node.named_label, node)
 
     if node.fields:
-        fields_tree = tree.add(
-            f"[bold green]fields[/]:", node, expand=expand, allow_expand=allow_expand
-        )
-        for field_name, field_data in node.rich_fields().items():
-            fields_tree.add_leaf(
-                f"[bold yellow]{field_name}[/]: {field_data}",
-                node.fields[field_name],
-            )
+        fields_tree = tree.add(FIELDS_LABEL, node, expand=expand, allow_expand=allow_expand)
+        for (field_name, field_data), field_ in zip(node.rich_fields, node.fields.values()):
+            fields_tree.add_leaf(f"[bold yellow]{field_name}[/]: {field_data}", field_)
 
     if node.children:
-
-        multiple_indicator = "[bold orange1]*[/]" if node.children.multiple else ""
-        optional_indicator = "[bold orange1]?[/]" if not node.children.required else ""
-        children_label = f"{multiple_indicator}[bold green]children[/]{optional_indicator}:"
         children_tree = tree.add(
-            children_label,
+            node.children_label,
             node.children,
             expand=expand,
             allow_expand=allow_expand,
         )
 
-        for i, (child_name, child_data) in enumerate(node.rich_children().items()):
-            children_tree.add_leaf(
-                f"[bold yellow]{child_name}[/]: {child_data}",
-                node.children.types[i],
-            )
+        for (child_name, child_data), child_type in zip(node.rich_children, node.children.types):
+            children_tree.add_leaf(f"[bold yellow]{child_name}[/]: {child_data}", child_type)
 
     return tree
 
@@ -94,25 +119,94 @@ def nodes_textual_tree(nodes: list[TreeSitterType], language: Language) -> Tree:
     """Print a tree of the nodes in a rich format."""
 
     node_tree = Tree(f"Tree Sitter Nodes: [bold]{language.name}[/]")
-    root_node = node_tree.root
-    root_node.expand()
+    populate_textual_tree(node_tree, nodes, language)
+    return node_tree
 
-    for node in nodes:
-        add_tree_node(root_node, node)
 
-    return node_tree
+def populate_textual_tree(
+    node_tree: Tree, nodes: list[TreeSitterType], language: Language
+) -> None:
+    """Replace the contents of an existing tree with the nodes of `language`."""
+
+    node_tree.clear()
+    node_tree.cursor_line = -1
+    root_node = node_tree.root
+    root_node.set_label(f"Tree Sitter Nodes: [bold]{language.name}[/]")
+
+    with batch_tree_updates(node_tree):
+        root_node.expand()
+        for node in nodes:
+            add_tree_node(root_node, node)
 
 
 def expand_recursively(node: TreeNode) -> None:
-    node.expand()
-    for child in node.children:
-        expand_recursively(child)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node.expand()
+        stack.extend(node.children)
 
 
 def collapse_recursively(node: TreeNode) -> None:
-    node.collapse()
-    for child in node.children:
-        collapse_recursively(child)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node.collapse()
+        stack.extend(node.children)
+
+
+def expanded_paths(tree: Tree) -> set[tuple[int, ...]]:
+    """Get the index paths, from the root, of the expanded nodes below the root of `tree`.
+
+    Paths are used rather than labels, as sibling nodes often share a label.
+    """
+    paths = set()
+    stack = [(child, (i,)) for i, child in enumerate(tree.root.children)]
+    while stack:
+        node, path = stack.pop()
+        if node.is_expanded:
+            paths.add(path)
+            stack.extend((child, (*path, i)) for i, child in enumerate(node.children))
+    return paths
+
+
+def expand_paths(tree: Tree, paths: set[tuple[int, ...]]) -> None:
+    """Expand the nodes of `tree` at the given index paths, as from `expanded_paths`."""
+    with batch_tree_updates(tree):
+        for path in paths:
+            node = tree.root
+            for i in path:
+                node = node.children[i]
+            node.expand()
+
+
+def _render_selected(tree: Tree, data: TreeSitterType | TreeSitterField | None) -> None:
+    """Show the details of the selected type or field in `tree`."""
+
+    if isinstance(data, TreeSitterType):
+        possible_types = data.fields
+    elif isinstance(data, TreeSitterField):
+        possible_types = (t.name for t in data.types)
+    else:
+        return
+
+    # Only build the log message if there's a devtools console to send it to
+    devtools = tree.app.devtools
+    if devtools is not None and devtools.is_connected:
+        node_types = "\n  - ".join(possible_types)
+        tree.log.debug(f"Selected node. Possible types: \n - {node_types}")
+    tree.selected_node = data
+
+    tree.clear()
+    with batch_tree_updates(tree):
+        if isinstance(data, TreeSitterType):
+            add_tree_node(tree.root, data, expand=True)
+        else:
+            tree.root.add_leaf(_prefixed(MULTIPLE_PREFIX, data.multiple))
+            tree.root.add_leaf(_prefixed(REQUIRED_PREFIX, data.required))
+            node_types = tree.root.add(TYPES_LABEL, expand=True)
+            for type_ in data.types:
+                add_tree_node(node_types, type_, expand=True)
 
 
 class LanguageSelectView(Screen):
@@ -132,17 +226,27 @@ class LanguageSelectView(Screen):
             return "None"
 
 
+# Widgets can only be mounted in one place, so it's the names that are computed
+# up front rather than the list items themselves
+_LANGUAGE_NAMES = tuple(lang.value for lang in Language)
+
+
 class Sidebar(Static):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._lv = ListView(
-            *(ListItem(Label(lang), name=lang, classes="language_item") for lang in Language),
+            *(
+                ListItem(Label(name), name=name, classes="language_item")
+                for name in _LANGUAGE_NAMES
+            ),
             id="language_list",
         )
 
     def compose(self) -> ComposeResult:
         yield Static("Languages", classes="sidebar_header")
         yield self._lv
+
+    def on_mount(self, event: events.Mount) -> None:
         self._lv.focus()
 
     def on_list_view_highlighted(self, event: ListView.Highlighted) -> None:
@@ -161,29 +265,7 @@ class SelectedNodeInfo(Static):
     data: reactive[TreeSitterType | TreeSitterField | None] = None
 
     def watch_data(self):
-        if isinstance(self.data, TreeSitterType):
-            node_types = [t for t in self.data.fields.keys()]
-            node_types = "\n  - ".join(node_types)
-            self.log.debug(f"Selected node. Possible types: \n - {node_types}")
-            self.selected_node_info.selected_node = self.data
-
-            tree = self.selected_node_info
-            tree.clear()
-            add_tree_node(tree.root, self.data, expand=True)
-
-        elif isinstance(self.data, TreeSitterField):
-            node_types = [t.name for t in self.data.types]
-            node_types = "\n  - ".join(node_types)
-            self.log.debug(f"Selected node. Possible types: \n - {node_types}")
-            self.selected_node_info.selected_node = self.data
-
-            tree = self.selected_node_info
-            tree.clear()
-            tree.root.add_leaf(f"[bold green]multiple[/]: {self.data.multiple}")
-            tree.root.add_leaf(f"[bold green]required[/]: {self.data.required}")
-            node_types = tree.root.add(f"[bold green]types[/]", expand=True)
-            for type_ in self.data.types:
-                add_tree_node(node_types, type_, expand=True)
+        _render_selected(self.query_one(Tree), self.data)
 
     def compose(self) -> ComposeResult:
         yield Static("Selected Node Info", classes="sidebar_header")
@@ -214,6 +296,14 @@ class TreeVizApp(App):
         self._sidebar = Sidebar(id="sidebar", name="sidebar")
         self._sidebar.visible = True
         self._node_tree_expanded = False
+        self._types_cache: dict[Language, dict[str, TreeSitterType]] = {}
+        # Keeps a reference to the task loading a newly selected language
+        self._loading_task: asyncio.Task[None] | None = None
+        # The nodes that were left expanded in each language, and whether `e` last
+        # expanded or collapsed them all, restored when switching back to it; the
+        # language currently shown is recorded when switching away
+        self._expansion_state: dict[Language, tuple[set[tuple[int, ...]], bool]] = {}
+        self._node_tree_language: Language | None = language
         self.node_tree = self._build_tree(language)
         self.selected_node_info = Tree[TreeSitterType | TreeSitterField]("Selected Node Info")
         self.selected_node_info.auto_expand = True
@@ -251,59 +341,80 @@ class TreeVizApp(App):
             await self.show_sidebar()
 
     def action_expand_collapse(self) -> None:
-        if self._node_tree_expanded:
-            for child in self.node_tree.root.children:
-                collapse_recursively(child)
-        else:
-            expand_recursively(self.node_tree.root)
+        with batch_tree_updates(self.node_tree):
+            if self._node_tree_expanded:
+                for child in self.node_tree.root.children:
+                    collapse_recursively(child)
+            else:
+                expand_recursively(self.node_tree.root)
         self._node_tree_expanded = not self._node_tree_expanded
 
+    def _get_types(self, language: Language) -> dict[str, TreeSitterType]:
+        """Get the node types of `language`, loading them only on its first selection."""
+        types = self._types_cache.get(language)
+        if types is None:
+            types = self._types_cache[language] = load_types_cached(language)
+        return types
+
     def _build_tree(self, language: Language) -> Tree:
-        types = create_types_and_fields(language.node_types_dict)
-        new_node_tree = nodes_textual_tree(list(types.values()), language)
-        expand_recursively(new_node_tree.root)
-        return new_node_tree
+        types = self._get_types(language)
+        # Only the root starts expanded; deeper nodes are expanded as they're opened
+        return nodes_textual_tree(list(types.values()), language)
 
     def watch_selected_language(self, language: Language) -> None:
         self.log("selected language", language)
 
-        self.selected_node_info.clear()
-        new_node_tree = self._build_tree(language)
+        if self._node_tree_language is language:
+            return
 
-        self._node_tree_expanded = True
+        self.selected_node_info.clear()
 
-        self.mount(new_node_tree, after=self.node_tree)
-        self.node_tree.remove()
-        self.node_tree = new_node_tree
+        if self._node_tree_language is not None:
+            self._expansion_state[self._node_tree_language] = (
+                expanded_paths(self.node_tree),
+                self._node_tree_expanded,
+            )
+            self._node_tree_language = None
+
+        types = self._types_cache.get(language)
+        if types is not None:
+            self._show_types(language, types)
+            return
+
+        # The watcher runs inline in the app's message loop, so loading a large grammar
+        # is left to a task, with the loading itself in a thread to keep input going
+        self.node_tree.clear()
+        self.node_tree.root.set_label(f"Loading [bold]{language.name}[/]...")
+        self._loading_task = asyncio.create_task(self._load_language(language))
+
+    async def _load_language(self, language: Language) -> None:
+        types = await asyncio.to_thread(self._get_types, language)
+        if language is not self.selected_language:
+            # Another language was selected while this one was loading
+            return
+        self._show_types(language, types)
+
+    def _show_types(self, language: Language, types: dict[str, TreeSitterType]) -> None:
+        # Repopulate the existing tree widget rather than mounting a new one
+        populate_textual_tree(self.node_tree, list(types.values()), language)
+        # Only the root is expanded on the first visit
+        paths, self._node_tree_expanded = self._expansion_state.get(language, (set(), False))
+        expand_paths(self.node_tree, paths)
+        self.node_tree.scroll_home(animate=False)
+        self._node_tree_language = language
 
     async def on_mount(self) -> None:
         await self.show_sidebar()
 
-    def on_tree_node_selected(self, event: Tree.NodeSelected) -> None:
-        data: TreeSitterType = event.node.data
-        if isinstance(data, TreeSitterType):
-            node_types = [t for t in data.fields.keys()]
-            node_types = "\n  - ".join(node_types)
-            self.log.debug(f"Selected node. Possible types: \n - {node_types}")
-            self.selected_node_info.selected_node = data
-
-            tree = self.selected_node_info
-            tree.clear()
-            add_tree_node(tree.root, data, expand=True)
+    def on_tree_node_expanded(self, event: Tree.NodeExpanded) -> None:
+        # Expanding programmatically doesn't post NodeExpanded, so this only runs
+        # for nodes the user opened
+        if event.sender is self.node_tree:
+            with batch_tree_updates(self.node_tree):
+                expand_recursively(event.node)
 
-        elif isinstance(data, TreeSitterField):
-            node_types = [t.name for t in data.types]
-            node_types = "\n  - ".join(node_types)
-            self.log.debug(f"Selected node. Possible types: \n - {node_types}")
-            self.selected_node_info.selected_node = data
-
-            tree = self.selected_node_info
-            tree.clear()
-            tree.root.add_leaf(f"[bold green]multiple[/]: {data.multiple}")
-            tree.root.add_leaf(f"[bold green]required[/]: {data.required}")
-            node_types = tree.root.add(f"[bold green]types[/]", expand=True)
-            for type_ in data.types:
-                add_tree_node(node_types, type_, expand=True)
+    def on_tree_node_selected(self, event: Tree.NodeSelected) -> None:
+        _render_selected(self.selected_node_info, event.node.data)
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True, name="Tree Sitter Node Viz")
@@ -32,7 +32,6 @@ async def code_complete(
         presence_penalty=presence_penalty,
         frequency_penalty=frequency_penalty,
         best_of=best_of,
-        logprobs=5,
     )
     db["testing"].insert(
         {
@@ -45,59 +44,98 @@ async def code_complete(
     return response.choices[0].text
 
 
-async def prompt_testing(code: str, path: str | Path | None = None) -> str:
-
-    prompt = f"""
-    {f"# Module path: {path}" if path else ""}
+# The summary, edge cases and unit tests are all asked for in a single completion,
+# each section delimited by its own pair of markers
+_PROMPT = textwrap.dedent(
+    """\
     We will write unit tests for the code below while thinking step by step what unit tests will be required for verifying that the code works as intended.
 
     ```python
     {code}
     ```
 
+    First, we summarize the common usage cases of the code between <|start_summary|> and <|end_summary|>. Then, in addition to the common usage cases, we think of edge cases, listed between <|start_edge_cases|> and <|end_edge_cases|>. Finally, now that we have a list of common usage cases and edge cases, we write unit tests for the code using pytest, between <|start_unit_tests|> and <|end_unit_tests|>.
+
     The common usage cases of the code can be summarized as follows:
 
     <|start_summary|>
-    1.
-    """
-
-    prompt = textwrap.dedent(prompt.strip())
-    completions = await code_complete(prompt, stop=["<|end_summary|>"])
+    1."""
+)
 
-    print(completions)
 
-    prompt_2 = f"""
-    {prompt}{completions}\n    <|end_summary|>
+# The framing of the sections in the returned transcript, as if each had been
+# completed separately
+_EDGE_CASES_FRAME = textwrap.dedent(
+    """
+    <|end_summary|>
 
     In addition to the above common usage cases, we can also think of the following edge cases:
 
     <|start_edge_cases|>
-    1.
-    """
-    prompt_2 = textwrap.dedent(prompt_2.strip())
-
-    completions_2 = await code_complete(prompt_2, stop=["<|end_edge_cases|>"])
-    print(completions_2)
+    1."""
+)
 
-    prompt_3 = f"""
-    {prompt_2}{completions_2}\n    <|end_edge_cases|>
+_UNIT_TESTS_FRAME = textwrap.dedent(
+    """
+    <|end_edge_cases|>
 
     Now that we have a list of common usage cases and edge cases, we can write unit tests for the code.
 
     <|start_unit_tests|>
     ```python
-    import pytest
-    """
-    prompt_3 = textwrap.dedent(prompt_3.strip())
-    completions_3 = await code_complete(prompt_3, stop=["<|end_unit_tests|>", "```"])
-    print(completions_3)
+    import pytest"""
+)
 
-    final = f"""
-    {prompt_3}{completions_3}\n    <|end_unit_tests|>
-    ```
+_TRANSCRIPT_END = "\n<|end_unit_tests|>\n```"
+
+
+def _after(text: str, marker: str) -> str:
+    _, found, after = text.partition(marker)
+    return after if found else text
+
+
+def _split_sections(completion: str) -> tuple[str, str, str]:
+    """Split a completion of `_PROMPT` into its summary, edge cases and unit tests.
+
+    If a section's end marker is missing, the rest of the completion goes into
+    that section and the later ones are left empty.
     """
-    final = textwrap.dedent(final.strip())
-    return final
+    summary, _, rest = completion.partition("<|end_summary|>")
+    edge_cases, _, rest = _after(rest, "<|start_edge_cases|>").partition("<|end_edge_cases|>")
+    unit_tests = _after(rest, "<|start_unit_tests|>")
+    return summary, edge_cases, unit_tests
+
+
+async def prompt_testing(code: str, path: str | Path | None = None) -> str:
+
+    prompt = _PROMPT.format(code=code)
+    if path:
+        prompt = f"# Module path: {path}\n{prompt}"
+
+    # Room for the three sections, which used to get 600 tokens each
+    completion = await code_complete(prompt, stop=["<|end_unit_tests|>"], max_tokens=1800)
+    summary, edge_cases, unit_tests = _split_sections(completion)
+
+    # Only keep what follows the framing that the transcript adds back
+    summary = summary.rstrip()
+    edge_cases = edge_cases.strip().removeprefix("1.").rstrip()
+    unit_tests = unit_tests.strip().removeprefix("```python").lstrip("\n")
+    unit_tests = unit_tests.removeprefix("import pytest").removesuffix("```").rstrip()
+
+    for section in (summary, edge_cases, unit_tests):
+        print(section)
+
+    return "".join(
+        (
+            prompt,
+            summary,
+            _EDGE_CASES_FRAME,
+            edge_cases,
+            _UNIT_TESTS_FRAME,
+            unit_tests,
+            _TRANSCRIPT_END,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -6,17 +6,60 @@
 # with the packages listed above installed.
 
 import asyncio
-import atexit
 import os
+import signal
 import textwrap
 from dataclasses import dataclass
 from pathlib import Path
 
 import ewmh
+from Xlib import X
 from Xlib.xobject.drawable import Window
 from loguru import logger
 
 
+def get_wm_class(win: Window) -> tuple[str, str] | None:
+    """Get the class of a window, only asking the X server the first time."""
+    try:
+        return wm_classes[win.id]
+    except KeyError:
+        wm_class = win.get_wm_class()
+        # Not cached if unset, as the client may not have set it yet
+        if wm_class is not None:
+            wm_classes[win.id] = wm_class
+        return wm_class
+
+
+def get_client_list() -> list[Window]:
+    clients = ew.getClientList()
+    if len(wm_classes) > len(clients):
+        # Forget about windows that have been closed
+        client_ids = {win.id for win in clients}
+        for win_id in wm_classes.keys() - client_ids:
+            del wm_classes[win_id]
+    return clients
+
+
+def handle_x_events() -> None:
+    """Flag changes to the client list from the events Xlib has queued up.
+
+    Replies to other requests can pull events off the socket, so this is also
+    called before waiting on `client_list_changed` rather than only when the
+    X connection becomes readable.
+    """
+    while ew.display.pending_events():
+        event = ew.display.next_event()
+        if event.type == X.PropertyNotify and event.atom == client_list_atom:
+            client_list_changed.set()
+
+
+def watch_client_list() -> None:
+    """Have the X server notify us of changes to the client list."""
+    ew.root.change_attributes(event_mask=X.PropertyChangeMask)
+    ew.display.flush()
+    asyncio.get_running_loop().add_reader(ew.display.fileno(), handle_x_events)
+
+
 @dataclass
 class ScratchpadApp:
     window_class: tuple[str, str]
@@ -24,7 +67,7 @@ class ScratchpadApp:
 
     @property
     def windows(self) -> list[Window]:
-        return [win for win in ew.getClientList() if win.get_wm_class() == self.window_class]
+        return [win for win in get_client_list() if get_wm_class(win) == self.window_class]
 
     async def toggle_visible(self):
         wins = self.windows
@@ -39,38 +82,51 @@ class ScratchpadApp:
                 close_fds=True,
             )
 
-            for _ in range(int(win_wait_timeout / win_wait_interval)):
+            # Look for the window again whenever the client list changes
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + win_wait_timeout
+            while True:
+                client_list_changed.clear()
+                handle_x_events()
                 wins = self.windows
                 if len(wins) > 0:
                     just_spawned = True
                     break
-                await asyncio.sleep(win_wait_interval)
-            else:
-                logger.error(f"Failed to find window for {self.window_class}")
-                return
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    logger.error(f"Failed to find window for {self.window_class}")
+                    return
+                try:
+                    await asyncio.wait_for(client_list_changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
 
         # Toggle visibility of the windows
+        active_desktop = ew.getWmDesktop(ew.getActiveWindow())
         for win in wins:
+            win_desktop = ew.getWmDesktop(win)
             is_not_active = (
-                ew.getWmDesktop(win) != ew.getWmDesktop(ew.getActiveWindow())
-                and ew.getWmDesktop(win) != 4294967295
+                win_desktop != active_desktop and win_desktop != 4294967295
             )  # 0xFFFFFFFF - WM uses this to indicate sticky (should appear in all desktops)
 
+            # A _NET_WM_STATE message can change up to two states at once
             if just_spawned or is_not_active:
                 logger.info(f"Showing {self.window_class}")
-                ew.setWmState(win, 1, "_NET_WM_STATE_STICKY")
-                ew.setWmState(win, 1, "_NET_WM_STATE_ABOVE")
+                ew.setWmState(win, 1, "_NET_WM_STATE_STICKY", "_NET_WM_STATE_ABOVE")
                 ew.setWmState(win, 1, "_NET_WM_TYPE_DOCK")
             else:
                 logger.info(f"Hiding {self.window_class}")
                 ew.setWmDesktop(win, inactive_desktop)
-                ew.setWmState(win, 0, "_NET_WM_STATE_STICKY")
-                ew.setWmState(win, 0, "_NET_WM_STATE_ABOVE")
+                ew.setWmState(win, 0, "_NET_WM_STATE_STICKY", "_NET_WM_STATE_ABOVE")
                 ew.setWmState(win, 0, "_NET_WM_TYPE_DOCK")
 
+        # The messages are only buffered by Xlib until now
+        ew.display.flush()
+
 
-class ScratchpadReaderProtocol(asyncio.Protocol):
-    """The protocol that handles data being written to the scratchpad fifo.
+async def handle_commands(reader: asyncio.StreamReader) -> None:
+    """Handle the commands written to the scratchpad fifo, one per line.
 
     The data is the name of the app to toggle. If the app is not running,
     it will be spawned. If it is running and active, it will be hidden away
@@ -89,13 +145,19 @@ class ScratchpadReaderProtocol(asyncio.Protocol):
     You can then bind this to a key in your window manager, e.g.:
 
         bindsym $mod+Shift+s exec echo spotify > /run/user/1000/scratchpad.fifo
-    """
 
-    def data_received(self, data: bytes) -> None:
-        app_name = data.decode().strip()
+    Commands are handled one at a time, in the order they were written.
+    """
+    async for line in reader:
+        app_name = line.decode().strip()
+        if not app_name:
+            continue
         logger.info(f"Handling scratchpad command: {app_name!r}")
         if app_name in scratchpad_apps:
-            asyncio.create_task(scratchpad_apps[app_name].toggle_visible())
+            try:
+                await scratchpad_apps[app_name].toggle_visible()
+            except Exception:
+                logger.exception(f"Failed to toggle {app_name}")
         else:
             logger.error(f"Unknown app {app_name}")
 
@@ -129,24 +191,63 @@ async def main() -> None:
         else:
             logger.warning("Done, probably.")
 
-    with open(pid_file, "w") as f:
-        f.write(str(os.getpid()))
+    # Moved into place rather than rewritten, so that it's a new file the previous
+    # instance can tell apart from the one it created
+    pid_tmp = run_dir / f"scratchpad.pid.{os.getpid()}"
+    pid_tmp.write_text(str(os.getpid()))
+    os.replace(pid_tmp, pid_file)
 
     try:
         os.unlink(fifo_file)
     except FileNotFoundError:
         pass
     os.mkfifo(fifo_file, os.O_CREAT | 0o600)
+    run_files = {path: _file_id(path) for path in (pid_file, fifo_file)}
 
-    atexit.register(os.unlink, pid_file)
-    atexit.register(os.unlink, fifo_file)
-
-    file_io = os.fdopen(os.open(fifo_file, os.O_RDWR))
     loop = asyncio.get_running_loop()
-    await loop.connect_read_pipe(ScratchpadReaderProtocol, file_io)
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    try:
+        watch_client_list()
+
+        # Opened for writing as well, so the fifo doesn't hit EOF when a writer closes it
+        file_io = os.fdopen(os.open(fifo_file, os.O_RDWR), "rb", buffering=0)
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), file_io
+        )
+        commands = asyncio.create_task(handle_commands(reader))
+
+        await stop.wait()
+        logger.info("Shutting down")
+        commands.cancel()
+        transport.close()
+    finally:
+        remove_run_files(run_files)
+
 
-    while True:
-        await asyncio.sleep(1)
+def _file_id(path: Path) -> tuple[int, int]:
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def remove_run_files(run_files: dict[Path, tuple[int, int]]) -> None:
+    """Remove the pid file and fifo, unless a new instance has replaced them.
+
+    `run_files` maps each path to the device and inode of the file this instance
+    created, and a path is only unlinked if it still refers to that file. As a new
+    instance creates its files right after sending us SIGTERM, there's still a
+    short window between the check and the unlink in which one of its files can
+    be removed, but it's no longer the whole time it takes us to shut down.
+    """
+    for path, file_id in run_files.items():
+        try:
+            if _file_id(path) == file_id:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
 
 
 if __name__ == "__main__":
@@ -159,10 +260,12 @@ if __name__ == "__main__":
     fifo_file = run_dir / "scratchpad.fifo"
 
     ew = ewmh.EWMH()
+    client_list_atom = ew.display.intern_atom("_NET_CLIENT_LIST")
+    client_list_changed = asyncio.Event()
+    wm_classes: dict[int, tuple[str, str]] = {}
 
     inactive_desktop = ew.getNumberOfDesktops() - 1
     win_wait_timeout = 3
-    win_wait_interval = 0.1
 
     scratchpad_apps = {
         "spotify": ScratchpadApp(